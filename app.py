@@ -1,8 +1,7 @@
 import os
+import functools
 from flask import Flask, render_template, request, jsonify, send_file
-from travel_plan import WalkarooTravelPlanner
-import pandas as pd
-import re
+from travel_plan import WalkarooTravelPlanner, _WS_RE
 from dotenv import load_dotenv
 
 app = Flask(__name__)
@@ -20,8 +19,8 @@ travel_planner = WalkarooTravelPlanner()
 def index():
     if request.method == "POST":
         # Aggressively clean inputs at the source to handle hidden characters
-        market_name = re.sub(r'\s+', ' ', request.form.get('market', '')).strip()
-        dealer_name = re.sub(r'\s+', ' ', request.form.get('dealer', '')).strip()
+        market_name = _WS_RE.sub(' ', request.form.get('market', '')).strip()
+        dealer_name = _WS_RE.sub(' ', request.form.get('dealer', '')).strip()
 
         if not market_name:
             return render_template("index.html", error="Market name is required")
@@ -63,8 +62,8 @@ def api_plan_route():
         return jsonify({"error": "Request must be JSON"}), 400
 
     # Aggressively clean inputs at the source
-    market_name = re.sub(r'\s+', ' ', data.get("market", "")).strip()
-    dealer_name = re.sub(r'\s+', ' ', data.get("dealer", "")).strip()
+    market_name = _WS_RE.sub(' ', data.get("market", "")).strip()
+    dealer_name = _WS_RE.sub(' ', data.get("dealer", "")).strip()
 
     if not market_name:
         return jsonify({"error": "Market name is required"}), 400
@@ -89,15 +88,18 @@ def api_plan_route():
 # -------------------------------
 # Source Data Viewer & Downloader
 # -------------------------------
+@functools.lru_cache(maxsize=1)
+def _render_source_html(source_mtime):
+    """Renders the source sheet as an HTML table. Keyed on the loaded sheet's mtime so a reloaded sheet is re-rendered."""
+    # Convert to HTML
+    return travel_planner.source_df.to_html(classes='table table-striped table-hover', index=False, border=0)
+
+
 @app.route("/view-source")
 def view_source_data():
     try:
-        source_path = travel_planner.source_file_path
-        # Load the single sheet
-        source_df = pd.read_excel(source_path, sheet_name="Sheet1")
-
-        # Convert to HTML
-        source_html = source_df.to_html(classes='table table-striped table-hover', index=False, border=0)
+        # Reload the sheet first if it was edited, so this page and new route plans use the same data
+        source_html = _render_source_html(travel_planner.refresh_if_changed())
 
         return render_template('view_source.html', source_table=source_html)
     except Exception as e:
@@ -109,11 +111,22 @@ def view_source_data():
 def download_source_data():
     try:
         source_path = travel_planner.source_file_path
-        return send_file(source_path, as_attachment=True, download_name='source_data.xlsx')
+        # Let browsers revalidate with ETag/Last-Modified and get a 304 instead of re-downloading the workbook
+        return send_file(
+            source_path,
+            as_attachment=True,
+            download_name='source_data.xlsx',
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(source_path),
+            max_age=300
+        )
     except Exception as e:
         return jsonify({"error": f"File not found or error sending file: {str(e)}"}), 404
 
 if __name__ == "__main__":
+    # Development server only; deployments run under gunicorn, e.g.
+    #   gunicorn --preload -k gthread -w 2 --threads 8 -b 0.0.0.0:5004 app:app
     # Run Flask app publicly (accessible via EC2 public IP)
     app.run(
         host='0.0.0.0',                     # makes it visible outside the server
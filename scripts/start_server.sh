@@ -1,5 +1,5 @@
 #!/bin/bash
 cd /home/ec2-user/my-app
 source venv/bin/activate
-pkill -f app.py || true
-nohup python app.py > app.log 2>&1 &
+pkill -f "gunicorn.*app:app" || true
+nohup gunicorn --preload -k gthread -w 2 --threads 8 -b 0.0.0.0:5004 app:app > app.log 2>&1 &
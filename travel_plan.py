@@ -1,20 +1,211 @@
 import pandas as pd
-from math import radians, cos, sin, asin, sqrt
+import numpy as np
+from numba import njit
+from math import radians
 import re
 import os
 import google.generativeai as genai
-import folium
+from jinja2 import Environment, FileSystemLoader
 import json
-
-# Moved haversine function outside the class to be a static utility function
-def haversine(lat1, lon1, lat2, lon2):
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+
+# Column names are sanitized by stripping everything except letters, digits and whitespace
+_COL_RE = re.compile(r'[^a-zA-Z0-9\s]')
+# Runs of whitespace (including hidden newlines) collapse to a single space in user input
+_WS_RE = re.compile(r'\s+')
+# Dealer names are cut at the first '(' or '-' to get the core name to search for
+_DEALER_SPLIT_RE = re.compile(r'\(|-')
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """Vectorized haversine over NumPy arrays. All inputs are expected in radians."""
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     return 6371 * c
 
+def _build_dist_matrix(lats, lons):
+    """
+    Builds the symmetric N x N haversine distance matrix (km) for coordinates given in degrees.
+    The matrix is computed and stored in float32 to halve the memory traffic of the route search.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    # Coordinate differences are taken from offsets around the centre of the shops, so float32 keeps them
+    # accurate to a few centimetres instead of losing them to cancellation between large absolute values.
+    lat_off = np.radians((lats - lats.mean()).astype(np.float32))
+    lon_off = np.radians((lons - lons.mean()).astype(np.float32))
+    cos_lat = np.cos(np.radians(lats.astype(np.float32)))
+    dlat = lat_off[None, :] - lat_off[:, None]
+    dlon = lon_off[None, :] - lon_off[:, None]
+    a = np.sin(dlat/2)**2 + cos_lat[:, None] * cos_lat[None, :] * np.sin(dlon/2)**2
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+@njit(cache=True, fastmath=True)
+def _greedy_route(dist_matrix, start_distances, avg_speed, visit_time, available_time):
+    """
+    Compiled nearest-neighbor traversal over a precomputed distance matrix.
+    Returns the visited shop indices with the distance (km) and travel time (min) from the previous stop.
+    """
+    n = start_distances.shape[0]
+    visited = np.zeros(n, dtype=np.bool_)
+    indices = np.empty(n, dtype=np.int64)
+    distances = np.empty(n, dtype=np.float64)
+    travel_times = np.empty(n, dtype=np.float64)
+    count = 0
+    current = -1
+    time_used = 0.0
+
+    while count < n and time_used < available_time:
+        # From the current location, find the nearest shop from ALL unvisited shops.
+        # An explicit "nothing found yet" index is used instead of an inf sentinel, which fastmath may not honour.
+        nearest = -1
+        nearest_dist = 0.0
+        for j in range(n):
+            if visited[j]:
+                continue
+            d = start_distances[j] if current < 0 else dist_matrix[current, j]
+            if nearest < 0 or d < nearest_dist:
+                nearest = j
+                nearest_dist = d
+
+        travel_time = (nearest_dist / avg_speed) * 60
+        if time_used + travel_time + visit_time > available_time:
+            # Not enough time for this stop, so the route is complete.
+            break
+
+        time_used += travel_time + visit_time
+        visited[nearest] = True
+        indices[count] = nearest
+        distances[count] = nearest_dist
+        travel_times[count] = travel_time
+        count += 1
+        # Update the current location to the shop that was just visited
+        current = nearest
+
+    return indices[:count], distances[:count], travel_times[:count]
+
+@njit(cache=True)
+def _leg(dist_matrix, start_distances, a, b):
+    """Distance (km) between two route positions, where -1 stands for the salesperson start."""
+    if a < 0:
+        return start_distances[b]
+    return dist_matrix[a, b]
+
+@njit(cache=True, fastmath=True)
+def _two_opt(route, dist_matrix, start_distances, avg_speed, visit_time, available_time):
+    """
+    Refines a nearest-neighbor route with 2-opt segment reversals. The start is fixed and the route end is open.
+    Whenever the shorter route frees enough of the time budget, the nearest unvisited shops are appended and
+    the refinement repeats. Returns the same (indices, distances, travel_times) as _greedy_route.
+    """
+    n = start_distances.shape[0]
+    # path[0] is the salesperson start, path[1:k + 1] the shops in visiting order
+    path = np.empty(n + 1, dtype=np.int64)
+    path[0] = -1
+    k = route.shape[0]
+    visited = np.zeros(n, dtype=np.bool_)
+    for p in range(k):
+        path[p + 1] = route[p]
+        visited[route[p]] = True
+
+    improved = True
+    while improved:
+        improved = False
+
+        # Reverse path[i + 1..j] whenever that shortens the route
+        for i in range(k):
+            for j in range(i + 2, k + 1):
+                delta = _leg(dist_matrix, start_distances, path[i], path[j]) - _leg(dist_matrix, start_distances, path[i], path[i + 1])
+                if j < k:
+                    delta += _leg(dist_matrix, start_distances, path[i + 1], path[j + 1]) - _leg(dist_matrix, start_distances, path[j], path[j + 1])
+                if delta < -1e-6:
+                    lo, hi = i + 1, j
+                    while lo < hi:
+                        path[lo], path[hi] = path[hi], path[lo]
+                        lo += 1
+                        hi -= 1
+                    improved = True
+
+        # Spend any time freed by the shorter route on the nearest remaining shops
+        time_used = 0.0
+        for p in range(k):
+            time_used += (_leg(dist_matrix, start_distances, path[p], path[p + 1]) / avg_speed) * 60 + visit_time
+        while k < n:
+            nearest = -1
+            nearest_dist = 0.0
+            for j in range(n):
+                if visited[j]:
+                    continue
+                d = _leg(dist_matrix, start_distances, path[k], j)
+                if nearest < 0 or d < nearest_dist:
+                    nearest = j
+                    nearest_dist = d
+            travel_time = (nearest_dist / avg_speed) * 60
+            if time_used + travel_time + visit_time > available_time:
+                break
+            time_used += travel_time + visit_time
+            visited[nearest] = True
+            k += 1
+            path[k] = nearest
+            improved = True
+
+    indices = path[1:k + 1].copy()
+    distances = np.empty(k, dtype=np.float64)
+    for p in range(k):
+        distances[p] = _leg(dist_matrix, start_distances, path[p], path[p + 1])
+    travel_times = (distances / avg_speed) * 60
+    return indices, distances, travel_times
+
+def _normalize_names(column):
+    """
+    Strips and lowercases a text column into a categorical.
+    Each distinct value is normalized once instead of every row, which matters for columns with few unique names.
+    """
+    codes, uniques = pd.factorize(column.astype(str))
+    # Distinct raw values can collapse to the same normalized name, so the categories are de-duplicated here
+    categories, remap = np.unique(np.asarray(uniques.str.strip().str.lower(), dtype=object), return_inverse=True)
+    # Missing values keep factorize's -1 code, which from_codes also treats as missing
+    return pd.Categorical.from_codes(np.where(codes >= 0, remap[codes], -1), categories=categories)
+
+def _match_category(column, term):
+    """
+    Returns a boolean row mask for a categorical column whose value contains `term` as a substring.
+    The substring search only runs over the small set of categories; rows are then matched on integer codes.
+    """
+    matching_codes = np.flatnonzero(column.cat.categories.str.contains(term, regex=False))
+    return column.cat.codes.isin(matching_codes).to_numpy()
+
+def _format_report(market, dealer, optimal_route, totals):
+    """Formats the pre-calculated route and summary totals into the plain-text route plan report."""
+    lines = [
+        f"- Market Name: {market}",
+        f"- Dealer Name: {dealer}"
+    ]
+    for i, shop in enumerate(optimal_route, 1):
+        lines += [
+            f"{i}) {'First Stop' if i == 1 else 'Next Stop'}",
+            f"   Shop Name: {shop['shop']}",
+            f"   Last Visit: {shop['last_visit']}",
+            f"   Distance from Previous: {shop.get('distance_from_previous', 0):.2f} km",
+            f"   Travel Time (with traffic): {shop.get('travel_time_from_previous', 0):.0f} min",
+            ""
+        ]
+    lines += [
+        f"- Total Distance: {totals['total_distance']:.2f} km",
+        f"- Total Travel Time (travel only, with traffic): {totals['total_travel_time']}",
+        f"- Total Visit Time: {totals['total_visit_time']}",
+        f"- Break Time: {totals['break_time']}",
+        f"- Total Workday Time: {totals['total_workday_time']}"
+    ]
+    return "\n".join(lines)
+
+# Route maps are rendered from a static Leaflet template instead of being built up element by element
+_MAP_TEMPLATE = Environment(loader=FileSystemLoader("templates"), autoescape=True).get_template("route_map.html")
+
 def format_minutes_to_hours(minutes):
     """Converts total minutes into a 'X hr Y min' string format."""
     if minutes < 0:
@@ -32,188 +223,167 @@ def format_minutes_to_hours(minutes):
 
 class WalkarooTravelPlanner:
     def __init__(self):
-        # ✅ Configure Gemini API
-        GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-        if not GOOGLE_API_KEY:
-            raise ValueError("GOOGLE_API_KEY environment variable not set. Please add it to your .env file.")
-        genai.configure(api_key=GOOGLE_API_KEY)
+        # The report is formatted locally unless the Gemini formatter is explicitly switched on
+        self.USE_LLM_FORMATTER = os.environ.get('USE_LLM_FORMATTER', 'False').lower() == 'true'
+        self.model = None
+        if self.USE_LLM_FORMATTER:
+            # ✅ Configure Gemini API
+            GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+            if not GOOGLE_API_KEY:
+                raise ValueError("GOOGLE_API_KEY environment variable not set. Please add it to your .env file.")
+            genai.configure(api_key=GOOGLE_API_KEY)
+            # One model instance is shared by every request so its client and connection are reused
+            self.model = genai.GenerativeModel("gemini-2.5-flash")
+            # Pool for the Gemini calls only. It defaults to the gunicorn --threads count so that every request
+            # thread in a worker can have a call in flight; LLM_FORMATTER_THREADS overrides it.
+            self._llm_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LLM_FORMATTER_THREADS', '8')))
 
         # ✅ Load single Excel sheet once
         self.source_file_path = r"public/Travel_plan 3.xlsx"
-        self.data_df = pd.read_excel(self.source_file_path, sheet_name="Sheet1")
+        self.parquet_file_path = r"public/Travel_plan_3.parquet"
+        self.source_mtime = os.path.getmtime(self.source_file_path)
+        # Keep the sheet exactly as loaded for the source viewer; routing works on the preprocessed copy
+        self.source_df = self.load_source_df()
+        self.data_df = self.preprocess(self.source_df.copy())
+        self._reload_lock = threading.Lock()
+        self._failed_mtime = None
 
         # Define constants for routing
         self.VISIT_TIME_PER_SHOP = 20
         self.TOTAL_BREAK_TIME = 75
         self.AVG_SPEED_KMH = 25
         self.TOTAL_WORKDAY_MINUTES = 9 * 60
-        self.preprocess()
 
-    def _sanitize_columns(self):
-        """Cleans all column names to a standard format (lowercase, snake_case)."""
-        cols = self.data_df.columns
-        new_cols = []
-        for col in cols:
-            # Remove special characters like '*', convert to lowercase, replace spaces with underscores
-            clean_col = re.sub(r'[^a-zA-Z0-9\s]', '', col).lower().strip().replace(' ', '_')
-            new_cols.append(clean_col)
-        self.data_df.columns = new_cols
-        print(f"[*] Sanitized column names to: {self.data_df.columns.tolist()}")
-
-    def preprocess(self):
-        self._sanitize_columns()
-        # Normalize key text columns for consistent filtering
-        self.data_df['distributorname'] = self.data_df['distributorname'].astype(str).str.strip().str.lower()
-        self.data_df["market"] = self.data_df["market"].astype(str).str.strip().str.lower()
+        # Finished plans keyed on (market, dealer, mtime of the loaded sheet); reloading an edited sheet invalidates them
+        self._route_cache = TTLCache(maxsize=256, ttl=3600)
+        self._route_cache_lock = threading.Lock()
+        # Map files this process has written for the sheet now in memory, removed once that sheet is replaced
+        self._map_paths = set()
+
+        # Warm the routing JIT on a dummy 2-shop input so the first real request doesn't pay the compile cost
+        self._find_route_for_9_hours(["", ""], np.zeros(2), np.zeros(2), ["", ""], 0.0, 0.0)
 
-    def _find_route_for_9_hours(self, shops, start_lat, start_lon):
+    def load_source_df(self):
         """
-        Calculates the optimal route that can be completed within a 9-hour workday.
-        This is a private helper method for the class.
+        Loads the source sheet through a Parquet copy of the Excel file.
+        The copy is regenerated whenever the .xlsx is newer, so parsing the workbook only happens after it changes.
+        The Parquet copy is only a cache: if it can't be written or read, the sheet is read from the .xlsx instead.
         """
-        AVAILABLE_TIME = self.TOTAL_WORKDAY_MINUTES - self.TOTAL_BREAK_TIME
-        
-        # This is a pure nearest-neighbor implementation.
-        unvisited = shops.copy()
-        route = []
-        current_lat, current_lon = start_lat, start_lon
-        time_used = 0
-
-        while unvisited and time_used < AVAILABLE_TIME:
-            # From the current location, find the nearest shop from ALL unvisited shops.
-            nearest_shop = min(unvisited, key=lambda shop: haversine(current_lat, current_lon, shop["lat"], shop["lon"]))
-            
-            distance_to_shop = haversine(current_lat, current_lon, nearest_shop["lat"], nearest_shop["lon"])
-            travel_time = (distance_to_shop / self.AVG_SPEED_KMH) * 60
-            
-            time_for_this_stop = travel_time + self.VISIT_TIME_PER_SHOP
-
-            if time_used + time_for_this_stop <= AVAILABLE_TIME:
-                # If there's enough time, add the shop to the route
-                time_used += time_for_this_stop
-                nearest_shop['distance_from_previous'] = distance_to_shop
-                nearest_shop['travel_time_from_previous'] = travel_time
-                route.append(nearest_shop)
-                unvisited.remove(nearest_shop)
-                # Update the current location to the shop that was just visited
-                current_lat, current_lon = nearest_shop["lat"], nearest_shop["lon"]
-            else:
-                # Not enough time for this stop, so the route is complete.
-                break
-        return route
-
-    def plan_optimal_route(self, market, dealer):
-        # Defensively clean inputs here to handle hidden characters like newlines, ensuring robust filtering.
-        market = re.sub(r'\s+', ' ', market).strip().lower()
-        dealer = re.sub(r'\s+', ' ', dealer).strip().lower()
-        print(f"\n[PROCESS START] Generating route for Market: '{market}', Dealer: '{dealer}'")
-        
-        # Create a copy of the main dataframe to work with
-        combined_df = self.data_df.copy()
-
-        market_mask = combined_df["market"].str.contains(re.escape(market), na=False) if market else True
-
-        if dealer:
-            # Preprocess the user's dealer input to be more forgiving.
-            # This will handle cases like "saleem brothers(cbe)-rush order" by searching for the core name.
-            dealer_search_term = re.split(r'\(|-', dealer)[0].strip()
-            print(f"[*] Searching for simplified dealer term: '{dealer_search_term}'")
-            # Filter on the sanitized distributorname column
-            dealer_mask = combined_df["distributorname"].str.contains(re.escape(dealer_search_term), case=False, na=False)
-
-        final_df = combined_df[market_mask & dealer_mask]
-        print(f"[1. FILTERING] Found {len(final_df)} initial records matching criteria.")
-
-        if final_df.empty:
-            if dealer:
-                print(f"[ERROR] No retailers found for the combination of Market: '{market}' and Dealer: '{dealer}'.")
-            else:
-                print(f"[ERROR] No retailers found for the given market: '{market}'.")
-            return None, None, None
-
-        # Create a working copy to avoid SettingWithCopyWarning
-        working_df = final_df.copy()
-        
-        # Convert 'LAST VISITED DATE' to datetime for proper sorting. 'coerce' handles errors.
-        working_df['last_visit_dt'] = pd.to_datetime(working_df['last_visited_date'], errors='coerce')
-        
-        # Sort by last visit date to prioritize shops that haven't been visited in a long time.
-        working_df.sort_values(by='last_visit_dt', ascending=True, na_position='first', inplace=True)
-
-        # Now that shops are prioritized, drop duplicates to keep only the highest-priority entry for each shop.
-        selected_shops_df = working_df.drop_duplicates(subset=["outletname"], keep='first').reset_index(drop=True)
-        print(f"[2. PRIORITIZING] Sorted {len(selected_shops_df)} unique shops by last visit date (oldest first).")
-        
-        if selected_shops_df.empty:
-            print("No retailers found with valid data.")
-            return None, None, None
-
-        # Find the first row with valid salesperson coordinates in the priority-sorted dataframe
-        valid_start_point_df = selected_shops_df[
-            selected_shops_df["salesperson_latitude"].notna() & 
-            selected_shops_df["salesperson_longitude"].notna()
-        ].copy()
-
-        if valid_start_point_df.empty:
-            print(f"[ERROR] Could not generate route for Market '{market}' and Dealer '{dealer}' because no valid salesperson start coordinates were found.")
-            return None, None, None
-
-        # Use the coordinates from the highest-priority shop that has them
-        salesperson_lat = valid_start_point_df.iloc[0]["salesperson_latitude"]
-        salesperson_lon = valid_start_point_df.iloc[0]["salesperson_longitude"]
-        start_shop_name = valid_start_point_df.iloc[0]["outletname"]
-        print(f"[3. START POINT] Selected salesperson start location ({salesperson_lat}, {salesperson_lon}) based on highest-priority shop: '{start_shop_name}'.")
-
+        if (os.path.exists(self.parquet_file_path)
+                and os.path.getmtime(self.parquet_file_path) >= os.path.getmtime(self.source_file_path)):
+            try:
+                return pd.read_parquet(self.parquet_file_path)
+            except Exception as e:
+                print(f"[WARN] Could not read Parquet cache '{self.parquet_file_path}', reloading from Excel: {e}")
+
+        source_df = pd.read_excel(self.source_file_path, sheet_name="Sheet1")
+        print(f"[*] Converting '{self.source_file_path}' to Parquet at '{self.parquet_file_path}'.")
+        # Write to a per-process temp file and swap it in, so concurrent loaders never read a half-written copy
+        tmp_path = f"{self.parquet_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
-            salesperson_lat = float(salesperson_lat)
-            salesperson_lon = float(salesperson_lon)
-        except (ValueError, TypeError):
-            print(f"[ERROR] Could not convert start coordinates to float for Market '{market}' and Dealer '{dealer}'. Values: {salesperson_lat}, {salesperson_lon}")
-            return None, None, None
+            source_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.parquet_file_path)
+        except Exception as e:
+            # e.g. an object column mixing text and numbers, which Excel allows but Parquet can't store
+            print(f"[WARN] Could not write Parquet cache, using the Excel data directly: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return source_df
 
-        shop_distances = []
-        for _, row in selected_shops_df.iterrows():
-            shop_lat = row["latitude"]
-            shop_lon = row["longitude"]
-            if pd.isna(shop_lat) or pd.isna(shop_lon):
-                continue
+    def refresh_if_changed(self):
+        """
+        Reloads and re-preprocesses the sheet when the source file has changed on disk since it was loaded.
+        Returns the mtime of the sheet now in memory. If the file can't be read (missing, or mid-save),
+        the data already in memory keeps being served.
+        """
+        try:
+            mtime = os.path.getmtime(self.source_file_path)
+            # A version that already failed to load is not retried until the file changes again
+            if mtime != self.source_mtime and mtime != self._failed_mtime:
+                with self._reload_lock:
+                    if mtime != self.source_mtime and mtime != self._failed_mtime:
+                        print(f"[*] '{self.source_file_path}' changed on disk, reloading source data.")
+                        source_df = self.load_source_df()
+                        data_df = self.preprocess(source_df.copy())
+                        # Swap the new frames in before publishing the new mtime, so a key with the new mtime never sees old data
+                        self.source_df = source_df
+                        self.data_df = data_df
+                        self.source_mtime = mtime
+                        self._prune_maps()
+        except Exception as e:
+            print(f"[WARN] Could not reload '{self.source_file_path}', keeping the data already loaded: {e}")
+            if 'mtime' in locals():
+                self._failed_mtime = mtime
+        return self.source_mtime
+
+    def _prune_maps(self):
+        """Drops the cached plans and deletes the map files written for the previous sheet."""
+        with self._route_cache_lock:
+            old_paths, self._map_paths = self._map_paths, set()
+            self._route_cache.clear()
+        for path in old_paths:
             try:
-                shop_lat = float(shop_lat)
-                shop_lon = float(shop_lon)
-                shop_distances.append({
-                    "shop": row["outletname"],
-                    "lat": shop_lat,
-                    "lon": shop_lon,
-                    "last_visit": str(row["last_visited_date"]) if pd.notna(row["last_visited_date"]) else "Never"
-                })
-            except (ValueError, TypeError):
-                continue
-
-        print(f"[4. DATA PREP] Prepared {len(shop_distances)} shops with valid coordinates for routing.")
-
-        if not shop_distances:
-            print("[ERROR] No retailers found with valid coordinates. Please check your data.")
-            return None, None, None
-
-        print("[5. ROUTING] Starting 9-hour nearest-neighbor route calculation...")
-        optimal_route = self._find_route_for_9_hours(shop_distances, salesperson_lat, salesperson_lon)
-        print(f"[5. ROUTING] Calculation complete. Optimal route contains {len(optimal_route)} stops.")
-
-        # Prepare data for the prompt
-        total_distance = sum(s.get('distance_from_previous', 0) for s in optimal_route)
-        total_travel_time = sum(s.get('travel_time_from_previous', 0) for s in optimal_route)
-        total_visit_time = len(optimal_route) * self.VISIT_TIME_PER_SHOP
-        total_workday_time = total_travel_time + total_visit_time + self.TOTAL_BREAK_TIME
+                os.remove(path)
+            except OSError:
+                pass
 
-        # Format times into "X hr Y min" strings for display
-        total_travel_time_str = format_minutes_to_hours(total_travel_time)
-        total_visit_time_str = format_minutes_to_hours(total_visit_time)
-        total_break_time_str = format_minutes_to_hours(self.TOTAL_BREAK_TIME)
-        total_workday_time_str = format_minutes_to_hours(total_workday_time)
+    def _sanitize_columns(self, df):
+        """Cleans all column names to a standard format (lowercase, snake_case)."""
+        # Remove special characters like '*', convert to lowercase, replace spaces with underscores
+        df.columns = [_COL_RE.sub('', col).lower().strip().replace(' ', '_') for col in df.columns]
+        print(f"[*] Sanitized column names to: {df.columns.tolist()}")
 
-        # Since dealer name is now required, we can use it directly.
-        dealer_name_for_output = dealer
+    def preprocess(self, df):
+        """Prepares a copy of the source sheet for routing and returns it."""
+        self._sanitize_columns(df)
+        # Normalize key text columns for consistent filtering
+        # Both columns hold a handful of distinct names, so they are stored as categoricals for cheap code-based filters.
+        df['distributorname'] = _normalize_names(df['distributorname'])
+        df["market"] = _normalize_names(df["market"])
+        # Convert 'LAST VISITED DATE' to datetime once for proper sorting. 'coerce' handles errors.
+        df['last_visit_dt'] = pd.to_datetime(df['last_visited_date'], errors='coerce')
+        # Keep the whole frame sorted by last visit date (oldest first, never-visited shops at the top).
+        # Filtering preserves row order, so requests get prioritized shops without sorting again.
+        return df.sort_values(
+            by='last_visit_dt', ascending=True, na_position='first', kind='mergesort'
+        ).reset_index(drop=True)
+
+    def _find_route_for_9_hours(self, names, lats, lons, last_visits, start_lat, start_lon):
+        """
+        Calculates the optimal route that can be completed within a 9-hour workday.
+        Shops are addressed by integer index into the aligned `names`, `lats`, `lons` and `last_visits` arrays.
+        Returns the list of stop dicts along with the visited shop indices in route order.
+        This is a private helper method for the class.
+        """
+        AVAILABLE_TIME = self.TOTAL_WORKDAY_MINUTES - self.TOTAL_BREAK_TIME
+        
+        # A nearest-neighbor route is built first and then tightened with 2-opt, which can make room for more shops.
+        # Distances are computed once up front: an N x N shop-to-shop matrix plus the start-to-shop vector.
+        # Both passes run as compiled code in _greedy_route and _two_opt.
+        dist_matrix = _build_dist_matrix(lats, lons)
+        start_distances = haversine_np(radians(start_lat), radians(start_lon), np.radians(lats), np.radians(lons))
+        route_args = (float(self.AVG_SPEED_KMH), float(self.VISIT_TIME_PER_SHOP), float(AVAILABLE_TIME))
+        greedy_indices, _, _ = _greedy_route(dist_matrix, start_distances, *route_args)
+        indices, distances, travel_times = _two_opt(greedy_indices, dist_matrix, start_distances, *route_args)
 
+        route = []
+        for idx, distance_to_shop, travel_time in zip(indices, distances, travel_times):
+            route.append({
+                "shop": names[idx],
+                "lat": float(lats[idx]),
+                "lon": float(lons[idx]),
+                "last_visit": last_visits[idx],
+                "distance_from_previous": float(distance_to_shop),
+                "travel_time_from_previous": float(travel_time)
+            })
+        return route, indices
+
+    def _call_gemini(self, market, dealer, optimal_route, totals):
+        """
+        Asks Gemini to format the pre-calculated route into the report. Only used when USE_LLM_FORMATTER is on.
+        Returns the report text and whether it came back successfully; API failures are returned as a
+        user-facing message instead of raising.
+        """
         # Create a detailed list of stops for the AI to use
         shops_info_for_prompt = ""
         for i, shop in enumerate(optimal_route, 1):
@@ -240,7 +410,7 @@ Format the output EXACTLY like this, using the data provided below.
 
 **FORMAT:**
 - Market Name: {market}
-- Dealer Name: {dealer_name_for_output}
+- Dealer Name: {dealer}
 1) First Stop  
    Shop Name: [Shop Name]  
    Last Visit: [Date]  
@@ -268,64 +438,195 @@ At the end, output:
 {shops_info_for_prompt}
 
 **SUMMARY TOTALS:**
-- Total Distance: {total_distance:.2f} km
-- Total Travel Time: {total_travel_time_str}
-- Total Visit Time: {total_visit_time_str}
-- Break Time: {total_break_time_str}
-- Total Workday Time: {total_workday_time_str}
+- Total Distance: {totals['total_distance']:.2f} km
+- Total Travel Time: {totals['total_travel_time']}
+- Total Visit Time: {totals['total_visit_time']}
+- Break Time: {totals['break_time']}
+- Total Workday Time: {totals['total_workday_time']}
 
 Do not add any explanation or extra text.
 """
 
-        print("[6. REPORTING] Sending calculated route to AI for formatting.")
         try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            response = model.generate_content(system_prompt + user_prompt)
-            gpt_route = response.text.strip()
+            response = self.model.generate_content(system_prompt + user_prompt)
+            return response.text.strip(), True
         except genai.types.generation_types.BlockedPromptException as e:
             print(f"[ERROR] The prompt was blocked by Google's safety settings: {e}")
-            gpt_route = "Report generation failed because the content was blocked by safety filters. Please check the data for any sensitive information."
+            return "Report generation failed because the content was blocked by safety filters. Please check the data for any sensitive information.", False
         except Exception as e:
             # Catch other potential API errors, including the ResourceExhausted error.
             print(f"[ERROR] An API error occurred during AI formatting: {e}")
             # Provide a user-friendly message that will be displayed in the results box.
-            gpt_route = "Could not generate the final report due to an API error. This is often caused by exceeding the daily usage quota. Please try again later or check your API plan."
+            return "Could not generate the final report due to an API error. This is often caused by exceeding the daily usage quota. Please try again later or check your API plan.", False
 
+    def _build_map(self, salesperson_lat, salesperson_lon, optimal_route):
+        """Renders the route map page into static/ and returns its URL."""
+        start = {"lat": salesperson_lat, "lng": salesperson_lon}
+        stops = [
+            {"name": shop['shop'], "lat": shop['lat'], "lng": shop['lon'], "last_visit": shop['last_visit']}
+            for shop in optimal_route
+        ]
 
-        # Create route points directly from optimal route
-        route_points = [(salesperson_lat, salesperson_lon)]
-        for shop in optimal_route:
-            route_points.append((shop['lat'], shop['lon']))
-        route_points.append((salesperson_lat, salesperson_lon))
+        # The file is named after the route it shows, so however a market/dealer is spelled in the request,
+        # the same route reuses one file and the number of map files stays bounded by the distinct routes in the data
+        route_hash = hashlib.sha1(json.dumps([start, stops], sort_keys=True).encode()).hexdigest()[:16]
+        os.makedirs("static", exist_ok=True)
+        map_path = os.path.join("static", f"route_{route_hash}.html")
+        # Write to a per-thread temp file and swap it in, so concurrent workers never serve a half-written map
+        tmp_path = f"{map_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(_MAP_TEMPLATE.render(start=start, stops=stops))
+        with self._route_cache_lock:
+            os.replace(tmp_path, map_path)
+            self._map_paths.add(map_path)
+        return "/" + map_path
 
-        print("[7. MAP GENERATION] Creating interactive map file.")
-        m = folium.Map(location=[salesperson_lat, salesperson_lon], zoom_start=12)
-        folium.Marker(
-            [salesperson_lat, salesperson_lon],
-            tooltip="Salesperson Start/End",
-            icon=folium.Icon(color="green", icon="star")
-        ).add_to(m)
+    def plan_optimal_route(self, market, dealer):
+        # Defensively clean inputs here to handle hidden characters like newlines, ensuring robust filtering.
+        market = _WS_RE.sub(' ', market).strip().lower()
+        dealer = _WS_RE.sub(' ', dealer).strip().lower()
+
+        cache_key = (market, dealer, self.refresh_if_changed())
+        with self._route_cache_lock:
+            cached_plan = self._route_cache.get(cache_key)
+        # Another worker may have pruned the map file behind a cached plan, in which case the plan is rebuilt
+        if cached_plan is not None and os.path.exists(cached_plan[1].lstrip("/")):
+            print(f"\n[CACHE HIT] Returning cached route for Market: '{market}', Dealer: '{dealer}'")
+            return cached_plan
+        plan, cacheable = self._generate_route_plan(market, dealer)
+        if cacheable:
+            with self._route_cache_lock:
+                self._route_cache[cache_key] = plan
+        return plan
+
+    def _generate_route_plan(self, market, dealer):
+        """
+        Runs the full filter, routing, reporting and map pipeline for already-cleaned inputs.
+        Returns the (route_text, map_url, retailers_json) plan and whether it is safe to cache.
+        """
+        print(f"\n[PROCESS START] Generating route for Market: '{market}', Dealer: '{dealer}'")
+        
+        # Read the frame once so a concurrent reload can't swap it out halfway through filtering
+        data_df = self.data_df
 
-        for i, shop in enumerate(optimal_route):
-            folium.Marker(
-                [shop['lat'], shop['lon']], 
-                tooltip=f"{i+1}. {shop['shop']}",
-                popup=f"<b>Stop {i+1}</b><br>Shop: {shop['shop']}<br>Last Visit: {shop['last_visit']}"
-            ).add_to(m)
+        # An empty search term matches every category, i.e. no filtering on that column
+        market_mask = _match_category(data_df["market"], market)
+
+        dealer_search_term = ""
+        if dealer:
+            # Preprocess the user's dealer input to be more forgiving.
+            # This will handle cases like "saleem brothers(cbe)-rush order" by searching for the core name.
+            dealer_search_term = _DEALER_SPLIT_RE.split(dealer)[0].strip()
+            print(f"[*] Searching for simplified dealer term: '{dealer_search_term}'")
+        # Filter on the sanitized distributorname column
+        dealer_mask = _match_category(data_df["distributorname"], dealer_search_term)
 
-        folium.PolyLine(route_points, color="blue", weight=4, opacity=0.7).add_to(m)
+        # Only the matching rows are materialized; the full frame is never copied
+        final_df = data_df[market_mask & dealer_mask]
+        print(f"[1. FILTERING] Found {len(final_df)} initial records matching criteria.")
 
-        os.makedirs("static", exist_ok=True)
-        map_path = os.path.join("static", "route_map.html")
-        m.save(map_path)
-        map_url = "/" + map_path
+        if final_df.empty:
+            if dealer:
+                print(f"[ERROR] No retailers found for the combination of Market: '{market}' and Dealer: '{dealer}'.")
+            else:
+                print(f"[ERROR] No retailers found for the given market: '{market}'.")
+            return (None, None, None), False
+
+        # data_df is already sorted by last visit date, so the filtered rows are prioritized as-is.
+        # Drop duplicates to keep only the highest-priority entry for each shop.
+        selected_shops_df = final_df.drop_duplicates(subset=["outletname"], keep='first').reset_index(drop=True)
+        print(f"[2. PRIORITIZING] Sorted {len(selected_shops_df)} unique shops by last visit date (oldest first).")
+        
+        if selected_shops_df.empty:
+            print("No retailers found with valid data.")
+            return (None, None, None), False
 
+        # Find the first row with valid salesperson coordinates in the priority-sorted dataframe
+        valid_start_point_df = selected_shops_df[
+            selected_shops_df["salesperson_latitude"].notna() & 
+            selected_shops_df["salesperson_longitude"].notna()
+        ].copy()
+
+        if valid_start_point_df.empty:
+            print(f"[ERROR] Could not generate route for Market '{market}' and Dealer '{dealer}' because no valid salesperson start coordinates were found.")
+            return (None, None, None), False
+
+        # Use the coordinates from the highest-priority shop that has them
+        salesperson_lat = valid_start_point_df.iloc[0]["salesperson_latitude"]
+        salesperson_lon = valid_start_point_df.iloc[0]["salesperson_longitude"]
+        start_shop_name = valid_start_point_df.iloc[0]["outletname"]
+        print(f"[3. START POINT] Selected salesperson start location ({salesperson_lat}, {salesperson_lon}) based on highest-priority shop: '{start_shop_name}'.")
+
+        try:
+            salesperson_lat = float(salesperson_lat)
+            salesperson_lon = float(salesperson_lon)
+        except (ValueError, TypeError):
+            print(f"[ERROR] Could not convert start coordinates to float for Market '{market}' and Dealer '{dealer}'. Values: {salesperson_lat}, {salesperson_lon}")
+            return (None, None, None), False
+
+        # Coordinates are converted column-wise; rows whose coordinates are missing or not numeric are skipped
+        lat_arr = pd.to_numeric(selected_shops_df["latitude"], errors="coerce").to_numpy(dtype=np.float64)
+        lon_arr = pd.to_numeric(selected_shops_df["longitude"], errors="coerce").to_numpy(dtype=np.float64)
+        valid = ~(np.isnan(lat_arr) | np.isnan(lon_arr))
+        routable_df = selected_shops_df[valid]
+
+        # Keep the shops as aligned arrays so routing can address them by index
+        names = routable_df["outletname"].to_numpy()
+        lats = lat_arr[valid]
+        lons = lon_arr[valid]
+        last_visits = [str(d) if pd.notna(d) else "Never" for d in routable_df["last_visited_date"]]
+
+        print(f"[4. DATA PREP] Prepared {len(names)} shops with valid coordinates for routing.")
+
+        if len(names) == 0:
+            print("[ERROR] No retailers found with valid coordinates. Please check your data.")
+            return (None, None, None), False
+
+        print("[5. ROUTING] Starting 9-hour nearest-neighbor + 2-opt route calculation...")
+        optimal_route, route_indices = self._find_route_for_9_hours(names, lats, lons, last_visits, salesperson_lat, salesperson_lon)
+        print(f"[5. ROUTING] Calculation complete. Optimal route contains {len(optimal_route)} stops.")
+
+        # Prepare data for the prompt
+        total_distance = sum(s.get('distance_from_previous', 0) for s in optimal_route)
+        total_travel_time = sum(s.get('travel_time_from_previous', 0) for s in optimal_route)
+        total_visit_time = len(optimal_route) * self.VISIT_TIME_PER_SHOP
+        total_workday_time = total_travel_time + total_visit_time + self.TOTAL_BREAK_TIME
+
+        # Format times into "X hr Y min" strings for display
+        total_travel_time_str = format_minutes_to_hours(total_travel_time)
+        total_visit_time_str = format_minutes_to_hours(total_visit_time)
+        total_break_time_str = format_minutes_to_hours(self.TOTAL_BREAK_TIME)
+        total_workday_time_str = format_minutes_to_hours(total_workday_time)
+
+        totals = {
+            "total_distance": total_distance,
+            "total_travel_time": total_travel_time_str,
+            "total_visit_time": total_visit_time_str,
+            "break_time": total_break_time_str,
+            "total_workday_time": total_workday_time_str
+        }
+
+        if self.USE_LLM_FORMATTER:
+            # The AI formatting call is network-bound, so the map is written on this thread while it is in flight.
+            print("[6. REPORTING] Sending calculated route to AI for formatting.")
+            fut_ai = self._llm_executor.submit(self._call_gemini, market, dealer, optimal_route, totals)
+            print("[7. MAP GENERATION] Creating interactive map file.")
+            map_url = self._build_map(salesperson_lat, salesperson_lon, optimal_route)
+            route_report, report_ok = fut_ai.result()
+        else:
+            print("[6. REPORTING] Formatting route report.")
+            route_report, report_ok = _format_report(market, dealer, optimal_route, totals), True
+            print("[7. MAP GENERATION] Creating interactive map file.")
+            map_url = self._build_map(salesperson_lat, salesperson_lon, optimal_route)
+
+        # Emit the retailers straight from the shop arrays using the route's indices
         retailers_json = [
             {"name": "Salesperson Start/End", "lat": salesperson_lat, "lng": salesperson_lon, "type": "start"}
-        ] + [
-            {"name": shop['shop'], "lat": shop['lat'], "lng": shop['lon'], "type": "shop"}
-            for shop in optimal_route
         ]
+        retailers_json.extend(
+            {"name": names[i], "lat": float(lats[i]), "lng": float(lons[i]), "type": "shop"}
+            for i in route_indices
+        )
 
         print("[PROCESS END] Route plan generated successfully. Returning results.")
-        return (gpt_route, map_url, retailers_json)
+        return (route_report, map_url, retailers_json), report_ok